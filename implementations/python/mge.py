@@ -23,8 +23,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import sys
+import os
 import optparse
-import copy
 try:
   import urwid
 except ImportError:
@@ -33,6 +33,8 @@ from textgraph import *
 
 class MultiTabEditor(urwid.Frame):
   def __init__(self,filenames):
+    # The urwid.MainLoop, set once it has been created.
+    self.loop = None
     # clipboard
     self.clipboard = Clipboard(self)
     self.clipboardBoxAdapter = urwid.BoxAdapter(self.clipboard,3)
@@ -65,11 +67,12 @@ class MultiTabEditor(urwid.Frame):
     self.view.updateStatusBar()
 
   def keypress(self,size,key):
+    actions = keyActions.get(key,noActions)
     value = None
-    if key in keybindings['next-tab']:
+    if 'next-tab' in actions:
       if self.currentTab < len(self.graphViews) - 1:
         self.currentTab += 1
-    elif key in keybindings['prev-tab']:
+    elif 'prev-tab' in actions:
       if self.currentTab > 0:
         self.currentTab -= 1
     elif key == 'esc':
@@ -77,9 +80,9 @@ class MultiTabEditor(urwid.Frame):
         self.focus_position = 'body'
       else:
         return super(MultiTabEditor,self).keypress(size,key)
-    elif key in keybindings['jump-to-command-bar'] and self.focus_position != 'footer':
+    elif 'jump-to-command-bar' in actions and self.focus_position != 'footer':
       self.focus_position = 'footer'
-    elif key in keybindings['jump-to-stack-area'] and self.focus_position == 'body':
+    elif 'jump-to-stack-area' in actions and self.focus_position == 'body':
       self.focus_position = 'header'
     else:
       value = super(MultiTabEditor,self).keypress(size,key)
@@ -94,7 +97,31 @@ class GraphView(urwid.WidgetPlaceholder):
     self.tabbedEditor = tabbedEditor
     self.history = []
     self._statusMessage = ""
+    self.saveDraftAlarm = None
+    self.statusBarAlarm = None
+    # The (selection, graph version, mode) that the widgets were last built for.
+    self.shownState = None
     self.graph.applyChangesHandler = self.update
+    self.graph.saveDraftHandler = self.scheduleDraftSave
+    # Command mode keys are looked up in a single dict rather than by testing each binding in turn.
+    self.commandModeHandlers = {}
+    for action,handler in [
+        ('insert-mode',self.insertMode),
+        ('back',self.goBack),
+        ('search-mode',self.searchMode),
+        ('show-map',self.showMap),
+        ('show-map-of-neighborhood',self.showMapOfNeighborhood),
+        ('go-down-default-street',self.goDownDefaultStreet),
+        ('go-up-default-street',self.goUpDefaultStreet),
+        ('clear-default-street-name',self.clearDefaultStreetName),
+        ('command-mode.up',self.moveUp),
+        ('command-mode.down',self.moveDown),
+        ('command-mode.left',self.moveLeft),
+        ('command-mode.right',self.moveRight),
+        ('command-mode.undo',self.undo),
+        ('command-mode.redo',self.redo)]:
+      for key in keybindings[action]:
+        self.commandModeHandlers.setdefault(key,handler)
     # incommingStreets
     self.incommingStreets = IncommingStreetsList(self)
     # current square
@@ -113,6 +140,8 @@ class GraphView(urwid.WidgetPlaceholder):
     self.incommingStreets.focusLastStreet()
 
   def update(self):
+    if self.shownState == (self.selection,self.graph.version,self.mode):
+      return
     # Make sure the selected square still exists...
     if self.selection not in self.graph:
       while self.history:
@@ -122,17 +151,58 @@ class GraphView(urwid.WidgetPlaceholder):
           break
       if not self.history:
         self.selection = 0
+    selectedSquare = self.selectedSquare
+    # If only the graph has changed, the street lists are left alone unless their streets or the squares at their far ends have changed.
+    if self.shownState is not None and self.shownState[0] == self.selection and self.shownState[2] == self.mode:
+      shownVersion = self.shownState[1]
+    else:
+      shownVersion = None
     # incommingStreets
-    incommingStreets = []
-    for incommingStreet in self.graph[self.selection].incommingStreets:
-      incommingStreets.append(copy.deepcopy(incommingStreet))
-    self.incommingStreets.update(incommingStreets)
+    # The street lists only read the streets they are given, edits are made to clones of the squares the streets belong to.
+    self.incommingStreets.update(selectedSquare.incommingStreets,shownVersion)
     # current square
-    self.currentSquare.edit_text = self.selectedSquare.text
+    if self.currentSquare.edit_text != selectedSquare.text:
+      self.currentSquare.edit_text = selectedSquare.text
     # streets
-    self.streets.update(self.selectedSquare.streets)
+    self.streets.update(selectedSquare.streets,shownVersion)
+    self.shownState = (self.selection,self.graph.version,self.mode)
+
+  def scheduleDraftSave(self):
+    """
+    Save a draft once the user has stopped editing for half a second, rather than blocking the keypress that triggered it.
+    """
+    loop = self.tabbedEditor.loop
+    if loop is None:
+      self.graph.saveDraft()
+      return
+    if self.saveDraftAlarm is not None:
+      loop.remove_alarm(self.saveDraftAlarm)
+    self.saveDraftAlarm = loop.set_alarm_in(0.5,self.saveDraft)
+
+  def saveDraft(self,loop,userData):
+    self.saveDraftAlarm = None
+    self.graph.saveDraft()
+
+  def scheduleStatusBarUpdate(self):
+    """
+    Update the status bar once all of the keys that are waiting have been handled, rather than after every one of them.
+    """
+    loop = self.tabbedEditor.loop
+    if loop is None:
+      self.updateStatusBar()
+    elif self.statusBarAlarm is None:
+      self.statusBarAlarm = loop.set_alarm_in(0,self.updateStatusBarLater)
+
+  def updateStatusBarLater(self,loop,userData):
+    self.statusBarAlarm = None
+    # The status bar is shared by all tabs.
+    if self.tabbedEditor.view is self:
+      self.updateStatusBar()
 
   def updateStatusBar(self):
+    """
+    Show the square the focus is on and the state of the graph. Only the street lists' streets are read, nothing is fetched from the server.
+    """
     if self.graph.readonly:
       edited = "Read only!"
     elif self.graph.edited:
@@ -144,23 +214,26 @@ class GraphView(urwid.WidgetPlaceholder):
         currentSquareId = self.searchBox.focused_square
       except IndexError:
         currentSquareId = 0
-    elif self.focus_item == self.incommingStreets:
+    elif self.focus_item is self.incommingStreets:
       try:
         currentSquareId = self.incommingStreets.streets[self.incommingStreets.focus_position].origin
       except IndexError:
         currentSquareId = self.selection
-    elif self.focus_item == self.streets:
+    elif self.focus_item is self.streets:
       try:
         currentSquareId = self.streets.streets[self.streets.focus_position].destination
       except IndexError:
         currentSquareId = self.selection
     else:
       currentSquareId = self.selection
-    self.tabbedEditor.statusBar.set_text("□:"+str(currentSquareId) + " " + edited + " Undo: "+str(len(self.graph.done))+" Redo: "+str(len(self.graph.undone))+" Mode: "+self.mode+" → "+self.defaultStreetName+" | "+self.statusMessage)
+    statusText = "□:"+str(currentSquareId) + " " + edited + " Undo: "+str(len(self.graph.done))+" Redo: "+str(len(self.graph.undone))+" Mode: "+self.mode+" → "+self.defaultStreetName+" | "+self.statusMessage
+    # Most keys, such as moving the focus within a street list, leave the status bar as it was.
+    if self.tabbedEditor.statusBar.text != statusText:
+      self.tabbedEditor.statusBar.set_text(statusText)
 
   def recordChanges(self):
     if self.selectedSquare.text != self.currentSquare.edit_text:
-      currentSquare = copy.deepcopy(self.selectedSquare)
+      currentSquare = self.selectedSquare
       currentSquare.text = self.currentSquare.edit_text
       self.graph.stageSquare(currentSquare)
       self.graph.applyChanges()
@@ -219,79 +292,99 @@ class GraphView(urwid.WidgetPlaceholder):
   def keypress(self,size,key):
     if self.mode == 'search':
       return self.keypressSearchmode(size, key)
+    actions = keyActions.get(key,noActions)
     focusedBeforeProcessing = self.focus_item
     try:
       value = self.handleKeypress(size,key)
     except AttributeError as e:
       self.statusMessage = str(e)
       value = None
-    if key in keybindings['command-mode.down'] and focusedBeforeProcessing == self.currentSquareWidget and self.focus_item == self.streets:
+    if 'command-mode.down' in actions and focusedBeforeProcessing is self.currentSquareWidget and self.focus_item is self.streets:
       self.streets.focus_position = 0
-    self.updateStatusBar()
+    self.scheduleStatusBarUpdate()
     return value
 
   def handleKeypress(self,size,key):
-    if key in ['left','right','up','down','home','end']:
-      self.recordChanges()
-      return super(GraphView,self).keypress(size,key)
-    if key in keybindings['command-mode'] and self.mode != 'command':
+    actions = keyActions.get(key,noActions)
+    if key in {'left','right','up','down','home','end'}:
+      # Edits are only recorded when the focus leaves the widget being edited, not every time the cursor moves within it.
+      focusedBefore = self.focus_item
+      value = super(GraphView,self).keypress(size,key)
+      if self.focus_item is not focusedBefore:
+        self.recordChanges()
+      return value
+    if 'command-mode' in actions and self.mode != 'command':
       self.recordChanges()
       self.mode = 'command'
     elif self.mode == 'command':
-      if key in keybindings['leave-and-go-to-mainer-part']:
+      if 'leave-and-go-to-mainer-part' in actions:
         self.focus_item = self.currentSquareWidget
       else:
         self.recordChanges()
-        if key in keybindings['insert-mode']:
-          self.mode = 'insert'
-          return None
-        if key in keybindings["back"]:
-          if self.history:
-            self._selection = self.history.pop()
-        elif key in keybindings['search-mode']:
-          self.mode = 'search'
-          self.searchBox.searchEdit.edit_text = ""
-          self.searchBox.update()
-          return None
-        elif key in keybindings['show-map']:
-          self.graph.showDiagram(markedSquares={self.selection:{"fontcolor":"white","fillcolor":"black","style":"filled"}})
-          return None
-        elif key in keybindings['show-map-of-neighborhood']:
-          self.graph.showDiagram(neighborhoodCenter = self.selection, neighborhoodLevel = 4,markedSquares={self.selection:{"fontcolor":"white","fillcolor":"black","style":"filled"}})
-          return None
-        elif key in keybindings['go-down-default-street']:
-          try:
-            self.selection = self.selectedSquare.lookupStreet(self.defaultStreetName).destination
-          except KeyError:
-            pass
-        elif key in keybindings['go-up-default-street']:
-          for street in self.incommingStreets.streets:
-            if street.name == self.defaultStreetName:
-              self.selection = street.origin
-              break
-        elif key in keybindings['clear-default-street-name']:
-          self.defaultStreetName = ""
-        elif key in keybindings['command-mode.up']:
-          return super(GraphView,self).keypress(size,'up')
-        elif key in keybindings['command-mode.down']:
-          return super(GraphView,self).keypress(size,'down')
-        elif key in keybindings['command-mode.left']:
-          return super(GraphView,self).keypress(size,'left')
-        elif key in keybindings['command-mode.right']:
-          return super(GraphView,self).keypress(size,'right')
-        elif key in keybindings['command-mode.undo']:
-          self.graph.undo()
-          if self.selection >= len(self.graph):
-            self.selection = 0
-          if self.selectedSquare.text is None:
-            self.selection = 0
-        elif key in keybindings['command-mode.redo']:
-          self.graph.redo()
-        else:
-          return super(GraphView,self).keypress(size,key)
+        handler = self.commandModeHandlers.get(key)
+        if handler is not None:
+          return handler(size)
+        return super(GraphView,self).keypress(size,key)
     else:
       return super(GraphView,self).keypress(size,key)
 
+  def insertMode(self,size):
+    self.mode = 'insert'
+
+  def goBack(self,size):
+    if self.history:
+      self._selection = self.history.pop()
+      self.update()
+      self.incommingStreets.focusLastStreet()
+
+  def searchMode(self,size):
+    self.mode = 'search'
+    self.searchBox.searchEdit.edit_text = ""
+    self.searchBox.reindex()
+
+  def showMap(self,size):
+    self.graph.showDiagram(markedSquares={self.selection:{"fontcolor":"white","fillcolor":"black","style":"filled"}})
+
+  def showMapOfNeighborhood(self,size):
+    self.graph.showDiagram(neighborhoodCenter = self.selection, neighborhoodLevel = 4,markedSquares={self.selection:{"fontcolor":"white","fillcolor":"black","style":"filled"}})
+
+  def goDownDefaultStreet(self,size):
+    try:
+      self.selection = self.selectedSquare.lookupStreet(self.defaultStreetName).destination
+    except KeyError:
+      pass
+
+  def goUpDefaultStreet(self,size):
+    for street in self.incommingStreets.streets:
+      if street.name == self.defaultStreetName:
+        self.selection = street.origin
+        break
+
+  def clearDefaultStreetName(self,size):
+    self.defaultStreetName = ""
+
+  def moveUp(self,size):
+    return super(GraphView,self).keypress(size,'up')
+
+  def moveDown(self,size):
+    return super(GraphView,self).keypress(size,'down')
+
+  def moveLeft(self,size):
+    return super(GraphView,self).keypress(size,'left')
+
+  def moveRight(self,size):
+    return super(GraphView,self).keypress(size,'right')
+
+  def undo(self,size):
+    self.graph.undo()
+    if self.selection >= len(self.graph):
+      self.selection = 0
+    if self.selectedSquare.text is None:
+      self.selection = 0
+
+  def redo(self,size):
+    self.graph.redo()
+
   def keypressSearchmode(self,size,key):
     if key == 'esc':
       self.mode = 'command'
@@ -307,6 +400,9 @@ class Clipboard(urwid.ListBox):
     self.selectionCollor = "clipboard"
     self.alignment = "right"
     self.squares = []
+    self.blankItem = urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(" ",0),align=self.alignment,width="pack"),None,self.selectionCollor)
+    # One row widget per stacked square, reused from one update to the next.
+    self.items = []
     super(Clipboard,self).__init__(urwid.SimpleFocusListWalker([]))
 
   @property
@@ -318,14 +414,24 @@ class Clipboard(urwid.ListBox):
       self.squares = squares
     items = []
     if not self.squares:
-      items.append(urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(" ",0),align=self.alignment,width="pack"),None,self.selectionCollor))
-    for square in self.squares:
-      items.append(urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(square[1].title,0),align=self.alignment,width="pack"),None,self.selectionCollor))
-    self.body.clear()
-    self.body.extend(items)
+      items.append(self.blankItem)
+    for i,square in enumerate(self.squares):
+      try:
+        item,icon = self.items[i]
+        if icon.text != square[1].title:
+          icon.set_text(square[1].title)
+      except IndexError:
+        icon = urwid.SelectableIcon(square[1].title,0)
+        item = urwid.AttrMap(urwid.Padding(icon,align=self.alignment,width="pack"),None,self.selectionCollor)
+        self.items.append((item,icon))
+      items.append(item)
+    # Replacing the body redraws the list, so only do so if the widgets have changed.
+    if self.body != items:
+      self.body[:] = items
 
   def keypress(self,size,key):
-    if key in keybindings["remove-from-stack"]:
+    actions = keyActions.get(key,noActions)
+    if "remove-from-stack" in actions:
       try:
         fcp = self.focus_position
       except IndexError:
@@ -335,27 +441,27 @@ class Clipboard(urwid.ListBox):
         self.update()
         if fcp < len(self.squares):
           self.focus_position = fcp
-    if key in keybindings['street-to-stack-item'] or key in keybindings['street-to-stack-item-no-pop']:
+    if 'street-to-stack-item' in actions or 'street-to-stack-item-no-pop' in actions:
       try:
         fcp = self.focus_position
       except IndexError:
         pass
       else:
         square = self.squares[fcp]
-        if not key in keybindings['street-to-stack-item-no-pop']:
+        if not 'street-to-stack-item-no-pop' in actions:
           del self.squares[fcp]
-        currentSquare = copy.deepcopy(self.view.selectedSquare)
+        currentSquare = self.view.selectedSquare
         currentSquare.streets.append(Street(self.view.defaultStreetName,square.squareId,currentSquare.squareId))
         self.view.graph.stageSquare(currentSquare)
         self.view.graph.applyChanges()
-    if key in keybindings['incommingStreet-to-stack-item'] or key in keybindings['incommingStreet-to-stack-item-no-pop']:
+    if 'incommingStreet-to-stack-item' in actions or 'incommingStreet-to-stack-item-no-pop' in actions:
       try:
         fcp = self.focus_position
       except IndexError:
         pass
       else:
         square = self.squares[fcp]
-        if not key in keybindings['incommingStreet-to-stack-item-no-pop']:
+        if not 'incommingStreet-to-stack-item-no-pop' in actions:
           del self.squares[fcp]
         square.streets.append(Street(self.view.defaultStreetName,self.view.selection,square.squareId))
         self.view.graph.stageSquare(square)
@@ -375,22 +481,23 @@ class CurrentSquare(urwid.Edit):
     return super(CurrentSquare,self).render(size,focus=focus)
 
   def keypress(self,size,key):
-    if key in keybindings['new-square-streeted-to-previous-square']:
+    actions = keyActions.get(key,noActions)
+    if 'new-square-streeted-to-previous-square' in actions:
       prevSquare = self.view.history[-1]
       self.view.recordChanges()
       newSquareId = self.view.graph.newLinkedSquare(prevSquare,self.view.defaultStreetName)
       self.view.selection = newSquareId
       self.view.history.append(prevSquare)
     if self.view.mode =='command':
-      if key in keybindings['add-to-stack']:
+      if 'add-to-stack' in actions:
         self.view.tabbedEditor.clipboard.squares.append((self.view.graph.filename,self.view.selectedSquare))
         self.view.tabbedEditor.clipboard.update()
-      elif key in keybindings['delete-square']:
+      elif 'delete-square' in actions:
         if self.view.selection != 0:
           self.view.graph.deleteSquare(self.view.selection)
         else:
           self.view.statusMessage = "Cannot delete square 0."
-      elif key in keybindings['delete-tree']:
+      elif 'delete-tree' in actions:
         self.view.graph.deleteTree(self.view.selection)
       elif not self.valid_char(key):
         value = super(CurrentSquare,self).keypress(size,key)
@@ -410,55 +517,110 @@ class StreetNavigator(urwid.ListBox):
     self.alignment = alignment
     self.streets = []
     self.streetNameEdits = []
+    self.blankItem = urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(" ",0),align=self.alignment,width="pack"),None,self.selectionCollor)
+    # Pools of command mode and insert mode rows, indexed by position in the list.
+    self.items = []
+    self.insertItems = []
     super(StreetNavigator,self).__init__(urwid.SimpleFocusListWalker([]))
 
-  def update(self,streets=None):
+  def farSquareIds(self):
+    if self.alignment == 'left':
+      return [street.origin for street in self.streets]
+    else:
+      return [street.destination for street in self.streets]
+
+  def commandModeItem(self,i,label,streetName):
+    """
+    Return the i-th command mode widget, showing the given label and street name.
+    """
+    try:
+      item,icon,streetNameText = self.items[i]
+      if icon.text != label:
+        icon.set_text(label)
+      if streetNameText.text != streetName:
+        streetNameText.set_text(streetName)
+    except IndexError:
+      icon = urwid.SelectableIcon(label,0)
+      streetNameText = urwid.Text(streetName)
+      selectable = urwid.AttrMap(urwid.Padding(icon,width="pack"),None,self.selectionCollor)
+      if self.alignment == 'left':
+        item = urwid.Columns([selectable,streetNameText])
+      else:
+        item = urwid.Columns([streetNameText,selectable])
+      self.items.append((item,icon,streetNameText))
+    return item
+
+  def insertModeItem(self,i,label,streetName):
+    """
+    Return the i-th insert mode widget, showing the given label and an editable street name.
+    """
+    try:
+      item,labelText,edit = self.insertItems[i]
+      if labelText.text != label:
+        labelText.set_text(label)
+      if edit.edit_text != streetName:
+        edit.set_edit_text(streetName)
+        edit.set_edit_pos(len(streetName))
+    except IndexError:
+      labelText = urwid.Text(label)
+      edit = urwid.Edit(edit_text=streetName)
+      if self.alignment == 'left':
+        item = urwid.Columns([labelText,edit])
+      else:
+        item = urwid.Columns([edit,labelText])
+      self.insertItems.append((item,labelText,edit))
+    self.streetNameEdits.append(edit)
+    return item
+
+  def update(self,streets=None,shownVersion=None):
+    """
+    Show the given streets. If shownVersion is given, the list is only rebuilt if the streets or the squares at their far ends have changed since that version of the graph.
+    """
     if streets is not None:
+      if shownVersion is not None and [(street.name,street.origin,street.destination) for street in streets] == [(street.name,street.origin,street.destination) for street in self.streets] and not self.view.graph.changedSince(self.farSquareIds(),shownVersion):
+        return
       self.streets = streets
     items = []
     self.streetNameEdits = []
     if not self.streets:
-      items.append(urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(" ",0),align=self.alignment,width="pack"),None,self.selectionCollor))
-    for street in self.streets:
+      items.append(self.blankItem)
+    # The squares at the far ends of the streets, fetched in one request.
+    farSquares = self.view.graph.getSquares(self.farSquareIds())
+    for i,(street,farSquare) in enumerate(zip(self.streets,farSquares)):
       if self.alignment == 'left':
-        if self.view.mode == 'command':
-          items.append(urwid.Columns([urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(self.view.graph[street.origin].title + " → ",0),width="pack"),None,self.selectionCollor),urwid.Text(street.name)]))
-        elif self.view.mode == 'insert':
-          edit = urwid.Edit(edit_text=street.name)
-          self.streetNameEdits.append(edit)
-          items.append(urwid.Columns([urwid.Text(self.view.graph[street.origin].title + " → "),edit]))
-      elif self.alignment == 'right':
-        if self.view.mode == 'command':
-          items.append(urwid.Columns([urwid.Text(street.name),urwid.AttrMap(urwid.Padding(urwid.SelectableIcon(" → " + self.view.graph[street.destination].title,0),width="pack"),None,self.selectionCollor)]))
-        elif self.view.mode == 'insert':
-          edit = urwid.Edit(edit_text=street.name)
-          self.streetNameEdits.append(edit)
-          items.append(urwid.Columns([edit,urwid.Text(" → " + self.view.graph[street.destination].title)]))
+        label = farSquare.title + " → "
+      else:
+        label = " → " + farSquare.title
+      if self.view.mode == 'command':
+        items.append(self.commandModeItem(i,label,street.name))
+      elif self.view.mode == 'insert':
+        items.append(self.insertModeItem(i,label,street.name))
     try:
       fp = self.focus_position
     except IndexError:
       fp = 0
-    self.body.clear()
-    self.body.extend(items)
+    if self.body != items:
+      self.body[:] = items
     if fp < len(items):
       self.focus_position = fp
 
   def keypress(self,size,key):
     if self.view.mode == "insert":
       return super(StreetNavigator,self).keypress(size,key)
-    if key in keybindings['new-square']:
+    actions = keyActions.get(key,noActions)
+    if 'new-square' in actions:
       self.view.selection = self.newStreetToNewSquare(useDefaultStreetName=True)
       self.view.focus_item = self.view.currentSquareWidget
       self.view.mode = 'insert'
-    if key in keybindings['new-square-with-blank-street-name']:
+    if 'new-square-with-blank-street-name' in actions:
       self.view.selection = self.newStreetToNewSquare(useDefaultStreetName=False)
       self.view.focus_item = self.view.currentSquareWidget
       self.view.mode = 'insert'
-    if key in keybindings['new-square-setting-street-name']:
+    if 'new-square-setting-street-name' in actions:
       self.newStreetToNewSquare(useDefaultStreetName=False)
       self.view.mode = 'insert'
       return None
-    if key in keybindings['set-default-street-name']:
+    if 'set-default-street-name' in actions:
       if self.streets:
         self.view.defaultStreetName = self.streets[self.focus_position].name
     if key in [self.alignment,'enter']:
@@ -472,21 +634,21 @@ class StreetNavigator(urwid.ListBox):
         self.view.selection = self.newStreetToNewSquare()
         self.view.focus_item = self.view.currentSquareWidget
         self.view.mode = 'insert'
-    if key in keybindings["delete-square"]:
+    if "delete-square" in actions:
       if self.streets:
         squareId = self.selectedSquareId
         if squareId != 0:
           self.view.graph.deleteSquare(squareId)
         else:
           self.view.statusMessage = "Cannot delete square 0."
-    if key in keybindings["delete-tree"]:
+    if "delete-tree" in actions:
       if self.streets:
         squareId = self.selectedSquareId
         if squareId != 0:
           self.view.graph.deleteTree(squareId)
         else:
           self.view.statusMessage = "Cannot delete square 0."
-    if key in keybindings["add-to-stack"]:
+    if "add-to-stack" in actions:
       if self.streets:
         self.view.tabbedEditor.clipboard.squares.append((self.view.graph.filename,self.view.graph[self.selectedSquareId]))
         self.view.tabbedEditor.clipboard.update()
@@ -513,7 +675,7 @@ class IncommingStreetsList(StreetNavigator):
           newStreetNamesBySquareOfOrigin[street.origin] = []
         newStreetNamesBySquareOfOrigin[street.origin].append(edit.edit_text)
       for squareOfOrigin,streetNames in newStreetNamesBySquareOfOrigin.items():
-        square = copy.deepcopy(self.view.graph[squareOfOrigin])
+        square = self.view.graph[squareOfOrigin]
         changed = False
         for street in square.streets:
           if street.destination == self.view.selection:
@@ -547,13 +709,14 @@ class IncommingStreetsList(StreetNavigator):
   def keypress(self,size,key):
     if self.view.mode == "insert":
       return super(IncommingStreetsList,self).keypress(size,key)
+    actions = keyActions.get(key,noActions)
     if key in ['right']:
       self.view.focus_item = self.view.streets
       try:
         self.view.streets.focus_position = 0
       except IndexError:
         pass
-    if key in keybindings['street-or-back-street-last-stack-item']:
+    if 'street-or-back-street-last-stack-item' in actions:
       if self.view.tabbedEditor.clipboard.squares:
         filenameOfOriginGraph,square = self.view.tabbedEditor.clipboard.squares.pop()
         self.view.tabbedEditor.clipboard.update()
@@ -561,11 +724,11 @@ class IncommingStreetsList(StreetNavigator):
         self.view.graph.stageSquare(square)
         self.view.graph.applyChanges()
         self.focus_position = len(self.streets) - 1
-    elif key in keybindings['remove-street-or-incommingStreet']:
+    elif 'remove-street-or-incommingStreet' in actions:
       try:
         fcp = self.focus_position
         street = self.streets[fcp]
-        square = copy.deepcopy(self.view.graph[street.origin])
+        square = self.view.graph[street.origin]
         square.streets = [street for street in square.streets if street.destination != self.view.selection]
         self.view.graph.stageSquare(square)
         self.view.graph.applyChanges()
@@ -581,7 +744,7 @@ class StreetsList(StreetNavigator):
 
   def recordChanges(self):
     if self.view.mode == 'insert':
-      square = copy.deepcopy(self.view.selectedSquare)
+      square = self.view.selectedSquare
       changed = False
       for street,streetEdit in zip(square.streets,self.streetNameEdits):
         if not street.name == streetEdit.edit_text:
@@ -609,31 +772,26 @@ class StreetsList(StreetNavigator):
   def keypress(self,size,key):
     if self.view.mode == "insert":
       return super(StreetsList,self).keypress(size,key)
-    if key in keybindings['move-square-up']:
-      sel = copy.deepcopy(self.view.selectedSquare)
+    actions = keyActions.get(key,noActions)
+    if 'move-square-up' in actions:
+      streets = self.view.selectedSquare.streets
       fcp = self.focus_position
       if fcp >= 1:
-        street = sel.streets[fcp]
-        prevStreet = sel.streets[fcp - 1]
-        sel.streets[fcp] = prevStreet
-        sel.streets[fcp - 1] = street
-        self.view.graph.stageSquare(sel)
+        streets[fcp - 1],streets[fcp] = streets[fcp],streets[fcp - 1]
+        self.view.graph.stageStreets(self.view.selection,streets)
         self.view.graph.applyChanges()
         self.focus_position = fcp - 1
-    elif key in keybindings['move-square-down']:
-      sel = copy.deepcopy(self.view.selectedSquare)
+    elif 'move-square-down' in actions:
+      streets = self.view.selectedSquare.streets
       fcp = self.focus_position
-      if fcp < len(sel.streets):
-        street = sel.streets[fcp]
-        nextStreet = sel.streets[fcp + 1]
-        sel.streets[fcp] = nextStreet
-        sel.streets[fcp + 1] = street
-        self.view.graph.stageSquare(sel)
+      if fcp + 1 < len(streets):
+        streets[fcp],streets[fcp + 1] = streets[fcp + 1],streets[fcp]
+        self.view.graph.stageStreets(self.view.selection,streets)
         self.view.graph.applyChanges()
         self.focus_position = fcp + 1
     elif key in ['left']:
       self.view.focus_item = self.view.incommingStreets
-    elif key in keybindings['street-or-back-street-last-stack-item']:
+    elif 'street-or-back-street-last-stack-item' in actions:
       if self.view.tabbedEditor.clipboard.squares:
         if self.streets:
           fcp = self.focus_position
@@ -641,18 +799,18 @@ class StreetsList(StreetNavigator):
           fcp = -1
         filenameOfOriginGraph,square = self.view.tabbedEditor.clipboard.squares.pop() #TODO!!
         self.view.tabbedEditor.clipboard.update()
-        sel = copy.deepcopy(self.view.selectedSquare)
-        sel.streets.insert(fcp + 1,Street(self.view.defaultStreetName,square.squareId,self.view.selection))
-        self.view.graph.stageSquare(sel)
+        streets = self.view.selectedSquare.streets
+        streets.insert(fcp + 1,Street(self.view.defaultStreetName,square.squareId,self.view.selection))
+        self.view.graph.stageStreets(self.view.selection,streets)
         self.view.graph.applyChanges()
         self.focus_position = fcp + 1
-    elif key in keybindings['remove-street-or-incommingStreet']:
+    elif 'remove-street-or-incommingStreet' in actions:
       try:
         fcp = self.focus_position
         street = self.streets[fcp]
-        selectedSquare = copy.deepcopy(self.view.selectedSquare)
-        selectedSquare.streets.remove(street)
-        self.view.graph.stageSquare(selectedSquare)
+        streets = self.view.selectedSquare.streets
+        streets.remove(street)
+        self.view.graph.stageStreets(self.view.selection,streets)
         self.view.graph.applyChanges()
       except IndexError:
         pass
@@ -662,22 +820,50 @@ class StreetsList(StreetNavigator):
 class SearchBox(urwid.ListBox):
   def __init__(self,view):
     self.view = view
-    self.squares = self.view.graph.values()
+    self.squares = []
+    # (square, lowercased text) pairs for every square, and the subset of them matching the last query.
+    self.index = []
+    self.indexVersion = None
+    self.matches = []
+    self.lastQuery = None
+    # Result widgets, reused between updates.
+    self.items = []
     super(SearchBox,self).__init__(urwid.SimpleFocusListWalker([]))
     self.searchEdit = urwid.Edit()
     self.body.append(self.searchEdit)
+    self.reindex()
+
+  def reindex(self):
+    """
+    Load the squares to be searched. Called when a new search begins.
+    """
+    # The index is only rebuilt if the graph has changed since the last search.
+    if self.indexVersion != self.view.graph.version:
+      self.index = [(square,square.text.lower()) for square in self.view.graph.values() if square.text is not None]
+      self.indexVersion = self.view.graph.version
+    self.lastQuery = None
     self.update()
 
   def update(self):
-    self.squares = []
-    items = []
-    for square in self.view.graph.values():
-      if square.text is not None:
-        if self.searchEdit.edit_text in square.text:
-          self.squares.append(square)
-          items.append(urwid.Padding(urwid.SelectableIcon(square.title,0),align='left',width="pack"))
-    del self.body[1:]
-    self.body.extend(items)
+    query = self.searchEdit.edit_text.lower()
+    if query == self.lastQuery:
+      return
+    # Squares that don't match a query won't match anything that query is a prefix of either.
+    if self.lastQuery is not None and query.startswith(self.lastQuery):
+      candidates = self.matches
+    else:
+      candidates = self.index
+    self.matches = [(square,text) for square,text in candidates if query in text]
+    self.lastQuery = query
+    self.squares = [square for square,_ in self.matches]
+    for item,square in zip(self.items,self.squares):
+      if item.original_widget.text != square.title:
+        item.original_widget.set_text(square.title)
+    for square in self.squares[len(self.items):]:
+      self.items.append(urwid.Padding(urwid.SelectableIcon(square.title,0),align='left',width="pack"))
+    items = self.items[:len(self.squares)]
+    if self.body[1:] != items:
+      self.body[1:] = items
     self.focus_position = 0
 
   @property
@@ -699,21 +885,27 @@ class SearchBox(urwid.ListBox):
         value = super(SearchBox,self).keypress(size,key)
         self.update()
         return value
-    if key in keybindings['command-mode.up']:
+    view = self.view
+    actions = keyActions.get(key,noActions)
+    if 'command-mode.up' in actions:
       return super(SearchBox,self).keypress(size,'up')
-    elif key in keybindings['command-mode.down']:
+    elif 'command-mode.down' in actions:
       return super(SearchBox,self).keypress(size,'down')
-    elif key in keybindings['jump-to-command-bar']:
-      self.view.focus_position = 'footer'
+    elif 'jump-to-command-bar' in actions:
+      view.focus_position = 'footer'
     elif key == 'enter':
-      self.view.selection = self.focused_square
-      self.view.mode = 'command'
-    elif key in keybindings['insert-mode']:
-      self.view.selection = self.focused_square
-      self.view.mode = 'insert'
-    elif key in keybindings['add-to-stack']:
-      self.view.tabbedEditor.clipboard.squares.append((self.view.graph.filename,self.view.graph[self.focused_square]))
-      self.view.tabbedEditor.clipboard.update()
+      # Leave search mode first, the street lists are empty while searching.
+      selection = self.focused_square
+      view.mode = 'command'
+      view.selection = selection
+    elif 'insert-mode' in actions:
+      selection = self.focused_square
+      view.mode = 'command'
+      view.selection = selection
+      view.mode = 'insert'
+    elif 'add-to-stack' in actions:
+      view.tabbedEditor.clipboard.squares.append((view.graph.filename,view.graph[self.focused_square]))
+      view.tabbedEditor.clipboard.update()
     else:
       return super(SearchBox,self).keypress(size,key)
 
@@ -721,6 +913,13 @@ class CommandBar(urwid.Edit):
   def __init__(self,editor):
     self.editor = editor
     self.edit = self
+    self.commands = {
+      "savedot":self.saveDot,
+      "w":self.write,
+      "q":self.quit,
+      "q!":self.forceQuit,
+      "wq":self.writeAndQuit,
+      "wq!":self.writeAndForceQuit}
     super(CommandBar,self).__init__(":")
 
   @property
@@ -730,57 +929,87 @@ class CommandBar(urwid.Edit):
   def keypress(self,size,key):
     if key != 'enter':
       return super(CommandBar,self).keypress(size,key)
-    success = False
+    view = self.view
+    success = True
     com = self.edit.edit_text
-    if com == "savedot":
-      success = True
-      try:
-        self.view.graph.saveDot()
-      except OSError as e:
-        self.view.statusMessage = str(e)
+    command = self.commands.get(com)
+    if command is not None:
+      command(view)
     elif com.startswith("o "):
-      success = True
-      try:
-        _,filename = com.split()
-      except ValueError:
-        self.view.statusMessage = "Need a path/URL to a file to open!"
-      try:
-        self.editor.graphViews.append(GraphView(TextGraph(filename),self.editor))
-        self.editor.currentTab = len(self.editor.graphViews) - 1
-      except (OSError,ValueError) as e:
-        self.view.statusMessage = str(e)
+      self.open(view,com)
+    elif com.isdecimal():
+      success = self.jump(view,com)
     else:
-      if "w" in com:
-        success = True
-        try:
-          self.view.recordChanges()
-          self.view.graph.save()
-          self.view.graph.edited = False
-        except (FileNotFoundError,OSError) as e:
-          self.edit.set_caption("Unable to save:"+str(e)+"\n:")
-      if "q" in com:
-        success = True
-        if self.view.graph.edited and "!" not in com:
-          self.edit.set_caption("Not quiting. Save your work first, or use 'q!'\n:")
-        else:
-          raise urwid.ExitMainLoop()
-      try:
-        newSelection = int(com)
-        if newSelection >= 0 and newSelection < len(self.view.graph) and self.view.graph[newSelection].text is not None:
-          self.view.selection = newSelection
-          self.view.focus_item = self.view.currentSquareWidget
-          self.view.mode = 'command'
-          success = True
-        else:
-          self.edit.set_caption("Cannot jump to "+com+". Square does not exist.\n:")
-      except ValueError:
-        pass
+      success = False
     self.edit.edit_text = ""
     if success:
       self.editor.focus_position = 'body'
+    elif com.isdecimal():
+      self.edit.set_caption("Cannot jump to "+com+". Square does not exist.\n:")
     else:
       self.edit.set_caption(com + " is not a valid mge command.\n:")
 
+  def saveDot(self,view):
+    try:
+      view.graph.saveDot()
+    except OSError as e:
+      view.statusMessage = str(e)
+
+  def write(self,view):
+    graph = view.graph
+    try:
+      view.recordChanges()
+      # Nothing to write if the file already holds the graph.
+      if graph.edited or not os.path.exists(graph.filename):
+        graph.save()
+      graph.edited = False
+    except (FileNotFoundError,OSError) as e:
+      self.edit.set_caption("Unable to save:"+str(e)+"\n:")
+
+  def quit(self,view):
+    if view.graph.edited:
+      self.edit.set_caption("Not quiting. Save your work first, or use 'q!'\n:")
+    else:
+      raise urwid.ExitMainLoop()
+
+  def forceQuit(self,view):
+    raise urwid.ExitMainLoop()
+
+  def writeAndQuit(self,view):
+    self.write(view)
+    self.quit(view)
+
+  def writeAndForceQuit(self,view):
+    self.write(view)
+    self.forceQuit(view)
+
+  def open(self,view,com):
+    try:
+      _,filename = com.split()
+    except ValueError:
+      view.statusMessage = "Need a path/URL to a file to open!"
+      return
+    try:
+      self.editor.graphViews.append(GraphView(TextGraph(filename),self.editor))
+      self.editor.currentTab = len(self.editor.graphViews) - 1
+    except (OSError,ValueError) as e:
+      view.statusMessage = str(e)
+
+  def jump(self,view,com):
+    newSelection = int(com)
+    # Squares which don't exist come back with no text, there is no need to fetch the whole graph to count them.
+    try:
+      square = view.graph[newSelection]
+    except TypeError:
+      # orjson refuses to encode ids beyond 64 bits, no such square can exist.
+      return False
+    if square.text is not None:
+      view.selection = newSelection
+      view.focus_item = view.currentSquareWidget
+      view.mode = 'command'
+      return True
+    return False
+
 keybindings = {
  # Superglobal / multitab editor
  'next-tab': ['meta page down'],
@@ -824,11 +1053,16 @@ keybindings = {
  'incommingStreet-to-stack-item-no-pop' : ['ctrl left'],
  'incommingStreet-to-stack-item' : ['left'],
  }
-pallet = [('incommingStreet_selected', 'white', 'dark blue')
+# Keys are tested for membership on every keypress.
+keybindings = {action:frozenset(keys) for action,keys in keybindings.items()}
+# The actions each key is bound to, so that a keypress only needs to look its key up once.
+keyActions = {key:frozenset(action for action,keys in keybindings.items() if key in keys) for keys in keybindings.values() for key in keys}
+noActions = frozenset()
+pallet = (('incommingStreet_selected', 'white', 'dark blue')
          ,('street_selected', 'white', 'dark red')
          ,('selection','black','white')
          ,('clipboard','white','dark gray')
-         ,('tabtitle','black','white')]
+         ,('tabtitle','black','white'))
 
 if __name__ == "__main__":
   parser = optparse.OptionParser(usage = "mge FILE",description = "Edit simple text graph file(tg file) using a simple,fast TUI interface.")
@@ -841,4 +1075,5 @@ if __name__ == "__main__":
     editor = MultiTabEditor(args)
   except (OSError,ValueError) as e:
     sys.exit(str(e))
-  urwid.MainLoop(editor,pallet,handle_mouse=False).run()
+  editor.loop = urwid.MainLoop(editor,pallet,handle_mouse=False)
+  editor.loop.run()
@@ -22,42 +22,36 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import sys
-import copy
+import io
 import json
 import subprocess
+import threading
 import os
 import collections.abc
+from tgserve import loads as jsonLoads
+from tgserve import dumps as jsonDumps
+
+class Street():
+  __slots__ = ("name","destination","origin","readonly")
 
-class Street(list):
   def __init__(self,name,destination,origin,readonly = False):
-    self.append(name)
-    self.append(destination)
+    self.name = name
+    self.destination = destination
     self.origin = origin
     self.readonly = readonly
 
-  @property
-  def name(self):
-    return self[0]
-
-  @name.setter
-  def name(self,value):
-    self[0] = value
-
-  @property
-  def destination(self):
-    return self[1]
-
-  @destination.setter
-  def destination(self,value):
-    self[1] = value
-
   def __repr__(self):
     return self.name + "→" + str(self.destination)
 
   def __eq__(self,other):
     return self.name == other.name and self.destination == other.destination
 
+  def clone(self):
+    return Street(self.name,self.destination,self.origin,self.readonly)
+
 class Square():
+  __slots__ = ("squareId","_text","_title","streets","readonly","incommingStreets")
+
   def __init__(self,squareId,text,streets,readonly = False,incommingStreets=None):
     self.squareId = squareId
     self.text = text
@@ -69,6 +63,15 @@ class Square():
   def __repr__(self):
     return str((self.squareId,self.text,self.streets))
 
+  @property
+  def text(self):
+    return self._text
+
+  @text.setter
+  def text(self,value):
+    self._text = value
+    self._title = None
+
   @property
   def list(self):
     streets = []
@@ -78,10 +81,24 @@ class Square():
 
   @property
   def title(self):
+    if self._title is None:
+      if self.text:
+        # Split only the first line rather than every line of the text.
+        firstLine = self.text.partition("\n")[0]
+        self._title = firstLine.splitlines()[0] if firstLine else ""
+      else:
+        self._title = "<blank-text>"
+    return self._title
+
+  def clone(self):
+    """
+    Return a copy of the square whose text and streets can be changed without affecting this square.
+    """
     try:
-      return self.text.splitlines()[0]
-    except IndexError:
-      return "<blank-text>"
+      incommingStreets = list(self.incommingStreets)
+    except AttributeError:
+      incommingStreets = None
+    return Square(self.squareId,self.text,[street.clone() for street in self.streets],readonly = self.readonly,incommingStreets = incommingStreets)
 
   def lookupStreet(self,streetName):
     for street in self.streets:
@@ -105,12 +122,10 @@ class TextGraphServer():
     self.proc = subprocess.Popen(["./tgserve.py",filename],stdin=subprocess.PIPE,stdout=subprocess.PIPE,close_fds=True)
 
   def send(self,query):
-    queryString = json.dumps(query)
-    queryString += "\n"
-    self.proc.stdin.write(queryString.encode("utf-8"))
+    self.proc.stdin.write(jsonDumps(query)+b"\n")
     self.proc.stdin.flush()
-    response = json.loads(self.proc.stdout.readline().decode("utf-8"))
-    returnCodes = json.loads(self.proc.stdout.readline().decode("utf-8"))
+    response = jsonLoads(self.proc.stdout.readline())
+    returnCodes = jsonLoads(self.proc.stdout.readline())
     return (response,returnCodes)
 
 class TextGraph(collections.abc.MutableMapping):
@@ -120,9 +135,44 @@ class TextGraph(collections.abc.MutableMapping):
     self.stagedSquares = []
     self.undone = []
     self.done = []
-    self.header = ""
+    self.header = self.readHeader()
+    # Bumped whenever squares are sent to the server, so that views can tell whether the graph has changed.
+    self.version = 0
+    # The version in which each square was last changed.
+    self.squareVersions = {}
     self.applyChangesHandler = lambda: None
+    self.saveDraftHandler = self.saveDraft
     self.server = TextGraphServer(filename)
+    # Squares fetched since the graph last changed. Callers get clones, so that they are free to modify them.
+    self._squares = {}
+    # Trees found by getTree since the graph last changed.
+    self._trees = {}
+    # Serialized lines of squares which have not changed since they were last serialized, and the whole serialized graph.
+    self._serializedSquares = {}
+    self._serialized = None
+    # The same for the dot diagram: (label, edges) of each square, and the whole unmarked diagram.
+    self._dotSquares = {}
+    self._dot = None
+    # The graph versions last written to the draft and dot files.
+    self._draftVersion = None
+    self._dotSavedVersion = None
+
+  def readHeader(self):
+    """
+    Return the comments and blank lines at the top of the file, so that they are kept when the file is saved.
+    The squares themselves are loaded by the server.
+    """
+    header = ""
+    try:
+      with open(self.filename,encoding="utf-8") as fd:
+        for line in fd:
+          line = line.rstrip("\n")
+          if line and not line.startswith("#"):
+            break
+          header += line+"\n"
+    except OSError:
+      pass
+    return header
 
   def _getAllSquares(self):
     allSquares = {}
@@ -132,11 +182,27 @@ class TextGraph(collections.abc.MutableMapping):
     return allSquares
 
   def __getitem__(self, key):
-    response,returnCodes = self.server.send([key])
-    return getSquareFromList(response[0],returnCodes[0])
+    try:
+      square = self._squares[key]
+    except KeyError:
+      response,returnCodes = self.server.send([key])
+      square = getSquareFromList(response[0],returnCodes[0])
+      self._squares[key] = square
+    return square.clone()
+
+  def getSquares(self,squareIds):
+    """
+    Return the squares with the given ids. Those which haven't been fetched since the graph last changed are fetched from the server in a single request.
+    """
+    missing = [squareId for squareId in dict.fromkeys(squareIds) if squareId not in self._squares]
+    if missing:
+      response,returnCodes = self.server.send([[squareId] for squareId in missing])
+      for square,permissions in zip(response,returnCodes):
+        self._squares[square[0]] = getSquareFromList(square,permissions)
+    return [self._squares[squareId].clone() for squareId in squareIds]
 
   def __setitem__(self, squareId, square):
-    self.server.send(square.list)
+    self._sendSquares([square])
 
   def __delitem__(self,key):
     self.__setitem__(key,Square(key,None,[]))
@@ -148,6 +214,38 @@ class TextGraph(collections.abc.MutableMapping):
   def __len__(self):
     return len(self._getAllSquares())
 
+  def items(self):
+    return self._getAllSquares().items()
+
+  def values(self):
+    return self._getAllSquares().values()
+
+  def _sendSquares(self,squares):
+    return self._sendSquareLists([square.list for square in squares])
+
+  def _sendSquareLists(self,squareLists):
+    """
+    Send changed squares to the server in their protocol form, forgetting their cached serializations.
+    A square sent without streets keeps the streets it already has.
+    """
+    self.version += 1
+    self._squares = {}
+    self._trees = {}
+    self._serialized = None
+    self._dot = None
+    for squareList in squareLists:
+      squareId = squareList[0]
+      self.squareVersions[squareId] = self.version
+      self._serializedSquares.pop(squareId,None)
+      self._dotSquares.pop(squareId,None)
+    return self.server.send(squareLists)
+
+  def changedSince(self,squareIds,version):
+    """
+    Return whether any of the given squares has changed since the given version of the graph.
+    """
+    return any(self.squareVersions.get(squareId,0) > version for squareId in squareIds)
+
   def allocSquare(self):
     """
     Return a new or free square Id.
@@ -156,7 +254,18 @@ class TextGraph(collections.abc.MutableMapping):
     return response[0][0]
 
   def stageSquare(self,square):
-    self.stagedSquares.append(copy.deepcopy(square))
+    self.stagedSquares.append(square.clone())
+
+  def stageStreets(self,squareId,streets):
+    """
+    Stage new streets for a square, keeping its text. The streets are staged as they are rather than being copied, so they should not be changed afterwards.
+    """
+    # The text is read from the cached square, so that none of its streets are cloned.
+    try:
+      text = self._squares[squareId].text
+    except KeyError:
+      text = self[squareId].text
+    self.stagedSquares.append(Square(squareId,text,streets))
 
   def applyChanges(self):
     if self.readonly:
@@ -164,20 +273,24 @@ class TextGraph(collections.abc.MutableMapping):
       return
     didNow = []
     didSomething = False
-    for square in self.stagedSquares:
-      prevState = self[square.squareId]
-      didNow.append((copy.deepcopy(prevState),copy.deepcopy(square)))
+    for square,prevState in zip(self.stagedSquares,self.getSquares([square.squareId for square in self.stagedSquares])):
+      # Most edits only change the text, so the streets are only recorded when they change.
+      if prevState.text is None or square.text is None or prevState.streets != square.streets:
+        streets = (prevState.list[2],square.list[2])
+      else:
+        streets = None
+      didNow.append((square.squareId,prevState.text,square.text,streets))
       if square.text is None:
         didSomething = True
-      elif not (prevState.text == square.text and prevState.streets == square.streets):
+      elif not (prevState.text == square.text and streets is None):
         didSomething = True
     if didSomething:
       self.undone = []
-      self.server.send([square.list for square in self.stagedSquares])
+      self._sendSquares(self.stagedSquares)
       self.stagedSquares = []
       self.done.append(didNow)
       if len(self.done)%5 == 0:
-        self.saveDraft()
+        self.saveDraftHandler()
       self.edited = True
       self.applyChangesHandler()
 
@@ -187,10 +300,7 @@ class TextGraph(collections.abc.MutableMapping):
     except IndexError:
       return
     self.edited = True
-    for (prevState,postState) in transaction:
-      self[prevState.squareId] = copy.deepcopy(prevState)
-      if prevState.text is None:
-        del self[prevState.squareId]
+    self._sendSquareLists([[squareId,prevText] if streets is None else [squareId,prevText,streets[0]] for squareId,prevText,postText,streets in transaction])
     self.undone.append(transaction)
     self.applyChangesHandler()
 
@@ -200,18 +310,14 @@ class TextGraph(collections.abc.MutableMapping):
     except IndexError:
       return
     self.edited = True
-    for (prevState,postState) in transaction:
-      if postState.text is not None:
-        self[postState.squareId] = copy.deepcopy(postState)
-      else:
-        del self[postState.squareId]
+    self._sendSquareLists([[squareId,postText] if streets is None else [squareId,postText,streets[1]] for squareId,prevText,postText,streets in transaction])
     self.done.append(transaction)
     self.applyChangesHandler()
 
   def newLinkedSquare(self,streetedSquareId,streetName):
     newSquareId = self.allocSquare()
     newSquare = Square(newSquareId,"",[])
-    selectedSquare = copy.deepcopy(self[streetedSquareId])
+    selectedSquare = self[streetedSquareId]
     selectedSquare.streets.append(Street(streetName,newSquareId,selectedSquare.squareId))
     self.stageSquare(newSquare)
     self.stageSquare(selectedSquare)
@@ -223,11 +329,14 @@ class TextGraph(collections.abc.MutableMapping):
     Get the changes that need to be preformed in order to delete a square.
     """
     changes = []
+    # The server indexes streets by destination, so the incomming streets are already at hand. Each origin is fetched once, even if it has several streets to this square.
+    origins = []
     for incommingStreet in self[squareId].incommingStreets:
-      if incommingStreet != squareId:
-        incommingStreetOrigin = copy.deepcopy(self[incommingStreet.origin])
-        incommingStreetOrigin.streets = [street for street in incommingStreetOrigin.streets if street.destination != squareId]
-        changes.append(incommingStreetOrigin)
+      if incommingStreet.origin != squareId and incommingStreet.origin not in origins:
+        origins.append(incommingStreet.origin)
+    for incommingStreetOrigin in self.getSquares(origins):
+      incommingStreetOrigin.streets = [street for street in incommingStreetOrigin.streets if street.destination != squareId]
+      changes.append(incommingStreetOrigin)
     changes.append(Square(squareId,None,[]))
     return changes
 
@@ -240,23 +349,40 @@ class TextGraph(collections.abc.MutableMapping):
     self.applyChanges()
 
   def getTree(self,squareId):
-    square = self[squareId]
-    tree = set([square.squareId])
-    for street in square.streets:
-      if not street.destination in tree:
-        tree.update(self.getTree(street.destination))
+    """
+    Return the ids of every square which can be reached by following streets out of the given square, including that square.
+    """
+    try:
+      return set(self._trees[squareId])
+    except KeyError:
+      pass
+    tree = set([squareId])
+    frontier = [squareId]
+    # Walk the tree a level at a time so that each level is fetched from the server in one request.
+    while frontier:
+      nextFrontier = []
+      for square in self.getSquares(frontier):
+        for street in square.streets:
+          if not street.destination in tree:
+            tree.add(street.destination)
+            nextFrontier.append(street.destination)
+      frontier = nextFrontier
+    self._trees[squareId] = frozenset(tree)
     return tree
 
   def deleteTree(self,squareId):
-    squaresForDeletion = set(self.getTree(squareId))
-    for square in self:
-      if not square.squareId in squaresForDeletion:
-        newStreets = []
-        for street in square.streets:
-          if not street.destination in squaresForDeletion:
-            newStreets.append(street.destination)
-        if newStreets != square.streets:
-          self.stageSquare(Square(square.squareId,square.text,newStreets))
+    squaresForDeletion = self.getTree(squareId)
+    # Square 0 is the root of the graph and is never deleted.
+    squaresForDeletion.discard(0)
+    # Only the squares with streets into the tree need changing, and the server already indexes those by destination.
+    origins = {}
+    for square in self.getSquares(list(squaresForDeletion)):
+      for street in square.incommingStreets:
+        if not street.origin in squaresForDeletion:
+          origins[street.origin] = None
+    for square in self.getSquares(list(origins)):
+      square.streets = [street for street in square.streets if not street.destination in squaresForDeletion]
+      self.stageSquare(square)
     for square in squaresForDeletion:
       self.stageSquare(Square(square,None,[]))
     self.applyChanges()
@@ -271,104 +397,142 @@ class TextGraph(collections.abc.MutableMapping):
 
   @property
   def json(self):
-    serialized = self.header
-    for _,square in self.sorted_items:
-      serialized += json.dumps([square.squareId,square.text,square.streets])
-      serialized += "\n"
-    return serialized
+    if self._serialized is None:
+      self._serialized = "".join(self.serializedLines())
+    return self._serialized
+
+  def serializedLines(self):
+    """
+    Return the header followed by one serialized line per square.
+    """
+    lines = [self.header]
+    for squareId,square in self.sorted_items:
+      try:
+        line = self._serializedSquares[squareId]
+      except KeyError:
+        line = json.dumps(square.list) + "\n"
+        self._serializedSquares[squareId] = line
+      lines.append(line)
+    return lines
+
+  def writeTo(self,fd):
+    """
+    Write the serialized graph to a file, line by line unless the whole serialization is already cached.
+    """
+    if self._serialized is not None:
+      fd.write(self._serialized)
+    else:
+      fd.writelines(self.serializedLines())
 
   @json.setter
   def json(self,text):
+    self._serialized = None
     self.header = ""
     readingHeader = True
-    lineNo = 0
-    sqr = 0
-    for line in text.splitlines():
+    squares = []
+    # Read line by line rather than splitting the whole text up front, and send the squares to the server all at once.
+    for lineNo,line in enumerate(io.StringIO(text)):
+      line = line.rstrip("\n")
       if not line or line.startswith("#"):
         if readingHeader:
           self.header += line+"\n"
       else:
         readingHeader = False
         try:
-          (squareId,text,streetsList) = json.loads(line)
+          (squareId,text,streetsList) = jsonLoads(line)
           streets = []
           for streetName,destination in streetsList:
             streets.append(Street(streetName,destination,squareId))
-          self[squareId] = Square(squareId,text,streets)
-          try:
-            if squareId >= self.nextSquareId:
-              self.nextSquareId = squareId + 1
-          except TypeError:
-            pass
+          squares.append(Square(squareId,text,streets))
         except ValueError as e:
           raise ValueError("Cannot load file "+self.filename+"\n"+ "Error on line: "+str(lineNo)+"\n"+str(e))
-      lineNo += 1
+    if squares:
+      self._sendSquares(squares)
 
   def __neighborhood(self,center,level):
     """
     Returns a list of squares around a given square.
     Level gives you some control over the size of the neighborhood.
     """
-    neighborhood = set()
-    squareIdsInNeighborhood = set()
-    edge = [self[center]]
-    # Build neighborhood
+    squaresInNeighborhood = {}
+    edge = [center]
+    # Build neighborhood, fetching each level in one request and each square only once.
     for _ in range(0,level):
       newEdge = []
-      for square in edge:
-        squareIdsInNeighborhood.add(square.squareId)
+      for square in self.getSquares([squareId for squareId in dict.fromkeys(edge) if squareId not in squaresInNeighborhood]):
+        squaresInNeighborhood[square.squareId] = square
         for street in square.streets:
-          newEdge.append(self[street.destination])
+          newEdge.append(street.destination)
         for street in square.incommingStreets:
-          newEdge.append(self[street.origin])
+          newEdge.append(street.origin)
       edge = newEdge
     # Remove streets that leave neighborhood.
     finalNeighborhood = []
-    for squareId in squareIdsInNeighborhood:
-      newSquare = copy.deepcopy(self[squareId])
-      newSquare.streets = [street for street in newSquare.streets if street.destination in squareIdsInNeighborhood]
-      finalNeighborhood.append(newSquare)
+    for square in squaresInNeighborhood.values():
+      square.streets = [street for street in square.streets if street.destination in squaresInNeighborhood]
+      finalNeighborhood.append(square)
     return finalNeighborhood
 
   def dot(self,markedSquares={},neighborhoodCenter=None,neighborhoodLevel=4):
     if neighborhoodCenter is None:
+      if not markedSquares and self._dot is not None:
+        return self._dot
       neighborhood = self.values()
     else:
       neighborhood = self.__neighborhood(neighborhoodCenter,neighborhoodLevel)
-    dot = "digraph graphname{\n"
-    labels = ""
-    edges = ""
+    labels = []
+    edges = []
     for square in neighborhood:
       if square.text is not None:
-        markings = ""
+        # A square's label and edges only change when the square does. Squares in a neighborhood have had streets removed, so they aren't cached.
+        if neighborhoodCenter is None and square.squareId in self._dotSquares:
+          label,squareEdges = self._dotSquares[square.squareId]
+        else:
+          label = str(square.squareId)+"[label="+json.dumps(square.title)
+          squareEdges = "".join([str(square.squareId)+" -> "+str(street.destination)+" [label="+json.dumps(street.name)+"]\n" for street in square.streets])
+          if neighborhoodCenter is None:
+            self._dotSquares[square.squareId] = (label,squareEdges)
+        labels.append(label)
         if square.squareId in markedSquares:
           for attr,value in markedSquares[square.squareId].items():
-            markings += "," + attr + " = " + value
-        labels += str(square.squareId)+"[label="+json.dumps(square.title)+markings+"]\n"
-        for street in square.streets:
-          edges += str(square.squareId)+" -> "+str(street.destination)+" [label="+json.dumps(street.name)+"]\n"
-    dot += labels
-    dot += edges
-    dot += "}"
+            labels.append("," + attr + " = " + value)
+        labels.append("]\n")
+        edges.append(squareEdges)
+    dot = "digraph graphname{\n" + "".join(labels) + "".join(edges) + "}"
+    if neighborhoodCenter is None and not markedSquares:
+      self._dot = dot
     return dot
 
   def showDiagram(self,neighborhoodCenter = None,neighborhoodLevel = 4,markedSquares={}):
-    subprocess.Popen(["dot","-T","xlib","/dev/stdin"],stdin=subprocess.PIPE).communicate(input=self.dot(markedSquares=markedSquares,neighborhoodCenter=neighborhoodCenter,neighborhoodLevel=neighborhoodLevel).encode("ascii"))
+    dot = self.dot(markedSquares=markedSquares,neighborhoodCenter=neighborhoodCenter,neighborhoodLevel=neighborhoodLevel).encode("ascii")
+    # dot runs until its window is closed, so feed it and wait for it on another thread rather than blocking the caller.
+    proc = subprocess.Popen(["dot","-T","xlib","/dev/stdin"],stdin=subprocess.PIPE)
+    threading.Thread(target=proc.communicate,args=(dot,),daemon=True).start()
 
   def save(self):
     if self.readonly:
       raise OSError(self.filename + " is read only.")
-    with open(self.filename,"w") as fd:
-      fd.write(self.json)
+    with open(self.filename,"w",encoding="utf-8") as fd:
+      self.writeTo(fd)
+      # Saved files are synced to disk. Drafts are disposable and are not.
+      fd.flush()
+      os.fsync(fd.fileno())
 
   def saveDraft(self):
-    if self.readonly:
+    if self.readonly or self._draftVersion == self.version:
       return
-    with open(os.path.join(os.path.dirname(self.filename),"."+os.path.basename(self.filename)+".draft"),"w") as fd:
-      fd.write(self.json)
+    draftFilename = os.path.join(os.path.dirname(self.filename),"."+os.path.basename(self.filename)+".draft")
+    # Write to a temporary file and move it into place so that a crash can't leave a half written draft.
+    with open(draftFilename+".tmp","w",encoding="utf-8") as fd:
+      self.writeTo(fd)
+    os.replace(draftFilename+".tmp",draftFilename)
+    self._draftVersion = self.version
 
   def saveDot(self):
     if self.readonly:
       raise OSError(self.filename + " is read only.")
-    with open(self.filename+".dot","w") as fd:
+    if self._dotSavedVersion == self.version and os.path.exists(self.filename+".dot"):
+      return
+    with open(self.filename+".dot","w",encoding="utf-8") as fd:
       fd.write(self.dot())
+    self._dotSavedVersion = self.version
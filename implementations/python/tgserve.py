@@ -1,9 +1,18 @@
 #!/usr/bin/python3
 import fileinput
 import json
+import bisect
 import sys
 import optparse
 import os
+# orjson encodes and parses much faster when it is available. Both encoders return UTF-8 bytes.
+try:
+  from orjson import loads
+  from orjson import dumps
+except ImportError:
+  from json import loads
+  def dumps(obj):
+    return json.dumps(obj).encode("utf-8")
 
 class TextGraphServer():
   def __init__(self,filepath = None):
@@ -18,16 +27,16 @@ class TextGraphServer():
       import urllib.request
       try:
         with urllib.request.urlopen(filepath) as webgraph:
-          for line in webgraph.read().decode("utf-8").splitlines():
-            self.interpretLine(line,outputResult = False)
+          for line in webgraph:
+            self.interpretLine(line.decode("utf-8").rstrip("\r\n"),outputResult = False)
           self.readonly = True
       except urllib.error.URLError as e:
         raise OSError(str(e))
     else:
       try:
-        with open(filepath) as fd:
-          for line in fd.read().splitlines():
-            self.interpretLine(line,outputResult = False)
+        with open(filepath,encoding="utf-8") as fd:
+          for line in fd:
+            self.interpretLine(line.rstrip("\n"),outputResult = False)
           self.readonly = False
       except FileNotFoundError:
         pass
@@ -40,7 +49,7 @@ class TextGraphServer():
     if line.startswith("#") or not line:
       return
     try:
-      inputObject = json.loads(line)
+      inputObject = loads(line)
     except ValueError as e:
       error = str(self.lineNo)+":"+line+"\nCould not be decoded.\n"+str(e)
       if repl:
@@ -77,10 +86,7 @@ class TextGraphServer():
       try:
         squareId = square[0]
         if squareId is None:
-          squareId = self.nextSquareId
-          self.nextSquareId += 1
-        elif isinstance(squareId,int) and squareId > self.nextSquareId:
-          self.nextSquareId = squareId + 1
+          squareId = self.allocSquareId()
       except IndexError:
         error = lineNo+":"+line + " is invalid."
         if repl:
@@ -89,44 +95,49 @@ class TextGraphServer():
         else:
           sys.exit(error)
       if self.readonly:
-        resultingSquares.append(self.graph[squareId]+[])
-        returnValues.append([squareId,"Read only",["Read only"]])
-        continue
-      try:
-        text = square[1]
-      except IndexError:
-        try:
-          _,text,streets = self.graph[squareId]
-        except KeyError:
+        if squareId not in self.graph:
           resultingSquares.append([squareId,None,[],[]])
           returnValues.append([squareId,"Square does not exist.","Square does not exist."])
           continue
-      try:
-        streets = square[2]
-      except IndexError:
+        resultingSquares.append(self.graph[squareId]+[self.streetsByDestination.get(squareId,[])])
+        returnValues.append([squareId,"Read only",["Read only"]])
+        continue
+      if len(square) == 1:
+        # Queries only read the square, the graph and the street index are left alone.
         try:
-          _,_,streets = self.graph[squareId]
+          _,text,streets = self.graph[squareId]
         except KeyError:
           resultingSquares.append([squareId,None,[],[]])
           returnValues.append([squareId,"Square does not exist.","Square does not exist."])
           continue
-      if text is None:
+      else:
+        text = square[1]
         try:
+          streets = square[2]
+        except IndexError:
+          try:
+            _,_,streets = self.graph[squareId]
+          except KeyError:
+            resultingSquares.append([squareId,None,[],[]])
+            returnValues.append([squareId,"Square does not exist.","Square does not exist."])
+            continue
+        if text is None:
+          if squareId not in self.graph:
+            resultingSquares.append([squareId,None,[],[]])
+            returnValues.append([squareId,"Square does not exist.","Square does not exist."])
+            continue
+          self.unindexStreets(squareId)
           del self.graph[squareId]
-        except KeyError:
-          resultingSquares.append([squareId,None,[],[]])
-          returnValues.append([squareId,"Square does not exist.","Square does not exist."])
-          continue
-      else:
-        if squareId in self.graph:
-          for street in self.graph[squareId][2]:
-            self.streetsByDestination[street[1]] = [street for street in self.streetsByDestination[street[1]] if street[0] != squareId]
-        self.graph[squareId] = [squareId,text,streets]
-        for name,destination in streets:
-          if not destination in self.streetsByDestination:
-            self.streetsByDestination[destination] = []
-          self.streetsByDestination[destination].append([squareId,name,destination])
-          self.streetsByDestination[destination].sort()
+        else:
+          # The same street names come up again and again, so only one copy of each is kept.
+          streets = [[sys.intern(name) if type(name) is str else name,destination] for name,destination in streets]
+          if squareId in self.graph:
+            self.reindexStreets(squareId,self.graph[squareId][2],streets)
+          else:
+            self.indexStreets(squareId,streets)
+          self.graph[squareId] = [squareId,text,streets]
+          if isinstance(squareId,int) and squareId >= self.nextSquareId:
+            self.nextSquareId = squareId + 1
       if squareId in self.streetsByDestination:
         incommingStreets = self.streetsByDestination[squareId]
       else:
@@ -134,10 +145,63 @@ class TextGraphServer():
       resultingSquares.append([squareId,text,streets,incommingStreets])
       returnValues.append([squareId,readWritePermissions,[readWritePermissions for _ in streets]])
     if outputResult:
-      sys.stdout.write(json.dumps(resultingSquares)+"\n")
-      sys.stdout.flush()
-      sys.stdout.write(json.dumps(returnValues)+"\n")
       sys.stdout.flush()
+      sys.stdout.buffer.write(dumps(resultingSquares)+b"\n"+dumps(returnValues)+b"\n")
+      sys.stdout.buffer.flush()
+
+  def allocSquareId(self):
+    """
+    Return a new square id.
+    Ids of deleted squares are never handed out again, as the editor may still refer to them in its history and stack.
+    """
+    squareId = self.nextSquareId
+    self.nextSquareId += 1
+    return squareId
+
+  def indexStreets(self,squareId,streets):
+    """
+    Add the streets leaving a square to the streetsByDestination index.
+    Each destination's list of incomming streets is kept sorted.
+    """
+    for name,destination in streets:
+      if not destination in self.streetsByDestination:
+        self.streetsByDestination[destination] = []
+      bisect.insort(self.streetsByDestination[destination],[squareId,name,destination])
+
+  def unindexStreets(self,squareId):
+    """
+    Remove the streets leaving a square from the streetsByDestination index.
+    Only the incomming street lists of that square's destinations are touched.
+    """
+    for destination in set(street[1] for street in self.graph[squareId][2]):
+      incommingStreets = [street for street in self.streetsByDestination[destination] if street[0] != squareId]
+      if incommingStreets:
+        self.streetsByDestination[destination] = incommingStreets
+      else:
+        del self.streetsByDestination[destination]
+
+  def reindexStreets(self,squareId,oldStreets,newStreets):
+    """
+    Update the streetsByDestination index when a square's streets change from oldStreets to newStreets.
+    Only the destinations whose streets from that square have changed are touched, so editing a square's text leaves the index alone.
+    """
+    oldNames = {}
+    for name,destination in oldStreets:
+      oldNames.setdefault(destination,[]).append(name)
+    newNames = {}
+    for name,destination in newStreets:
+      newNames.setdefault(destination,[]).append(name)
+    for destination in oldNames.keys() | newNames.keys():
+      names = sorted(newNames.get(destination,[]))
+      if sorted(oldNames.get(destination,[])) == names:
+        continue
+      incommingStreets = [street for street in self.streetsByDestination.get(destination,[]) if street[0] != squareId]
+      for name in names:
+        bisect.insort(incommingStreets,[squareId,name,destination])
+      if incommingStreets:
+        self.streetsByDestination[destination] = incommingStreets
+      else:
+        self.streetsByDestination.pop(destination,None)
 
   def repl(self):
     import readline
@@ -158,8 +222,9 @@ class TextGraphServer():
       self.interpretLine(input(),repl=True)
 
   def serve(self):
-    for line in iter(sys.stdin.readline,''):
-      self.interpretLine(line)
+    # Queries are UTF-8 whatever the locale.
+    for line in iter(sys.stdin.buffer.readline,b''):
+      self.interpretLine(line.decode("utf-8"))
 
 if __name__ == "__main__":
   parser = optparse.OptionParser(usage = "tgserve",description = "Dumb server for the textgraph protocol.")